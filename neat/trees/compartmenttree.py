@@ -18,6 +18,7 @@ from ..channels import channelcollection
 from ..tools import kernelextraction as ke
 
 import copy
+import hashlib
 import warnings
 import itertools
 from operator import mul
@@ -382,6 +383,24 @@ class CompartmentNode(SNode):
         return g * p_open * (v - e)
 
 
+class _ImpedanceCache(object):
+    """
+    Stores the impedance matrix of the last system matrix that was inverted,
+    together with a digest of that system matrix. Copies and unpickled
+    instances start out empty, so the cache is never duplicated along with
+    the tree
+    """
+    def __init__(self):
+        self.key = None
+        self.z_mat = None
+
+    def __deepcopy__(self, memo):
+        return self.__class__()
+
+    def __reduce__(self):
+        return (self.__class__, ())
+
+
 class CompartmentTree(STree):
     """
     Abstract tree that implements physiological parameters for reduced
@@ -393,6 +412,10 @@ class CompartmentTree(STree):
         self.channel_storage = {}
         # for fitting the model
         self.resetFitData()
+        # flattened identity matrix, only depends on the number of nodes
+        self._vec_eye = None
+        # impedance matrix of the last system matrix that was inverted
+        self._z_mat_cache = _ImpedanceCache()
 
     def _createCorrespondingNode(self, index, ca=1., g_c=0., g_l=1e-2):
         """
@@ -565,8 +588,13 @@ class CompartmentTree(STree):
         loc_inds = np.array([node.loc_ind for node in self])
         return np.argsort(loc_inds)
 
-    def _permuteToLocs(self, mat):
-        index_arr = self._permuteToLocsInds()
+    def _permuteToLocs(self, mat, loc_inds=None):
+        """
+        `loc_inds` are the location indices of the nodes in iteration order.
+        If given, they are used instead of iterating over the tree again
+        """
+        index_arr = self._permuteToLocsInds() if loc_inds is None else \
+                    np.argsort(loc_inds)
         if mat.ndim == 1:
             return mat[index_arr]
         elif mat.ndim == 2:
@@ -596,6 +624,9 @@ class CompartmentTree(STree):
         in `freqs`. This matrix is evaluated at the equilibrium potentials
         stored in each node
 
+        The inverse of the most recent system matrix is kept, so that it is
+        only recomputed when the system matrix changes
+
         Parameters
         ----------
             freqs: np.array (dtype = complex) or float
@@ -617,9 +648,65 @@ class CompartmentTree(STree):
                 frequency, the second and third dimension contain the impedance
                 matrix for that frequency
         """
-        return np.linalg.inv(self.calcSystemMatrix(freqs=freqs,
-                             channel_names=channel_names, indexing=indexing,
-                             use_conc=use_conc))
+        s_mat = self.calcSystemMatrix(freqs=freqs, channel_names=channel_names,
+                                      indexing='tree', use_conc=use_conc)
+        key = (s_mat.dtype.str, s_mat.shape,
+               hashlib.blake2b(s_mat.tobytes()).digest())
+        if self._z_mat_cache.key != key:
+            self._z_mat_cache.z_mat = np.linalg.inv(s_mat)
+            self._z_mat_cache.key = key
+        z_mat = self._z_mat_cache.z_mat
+        if indexing == 'locs':
+            return self._permuteToLocs(z_mat)
+        elif indexing == 'tree':
+            return z_mat.copy()
+        else:
+            raise ValueError('invalid argument for `indexing`, ' + \
+                             'has to be \'tree\' or \'locs\'')
+
+    def solveSystem(self, rhs, freqs=0., channel_names=None, indexing='locs',
+                          use_conc=False):
+        """
+        Computes the product of the impedance matrix of the model with `rhs`,
+        by solving the linear system defined by the system matrix. This avoids
+        computing the full impedance matrix when only its product with a
+        number of vectors is required. All vectors are solved for in a single
+        call, so the system matrix is factorized only once per frequency
+
+        Parameters
+        ----------
+            rhs: np.ndarray (ndim = 1, 2 or 3)
+                The vector(s) the impedance matrix is multiplied with. Shape is
+                ``(N,)`` or ``(N, K)``, or ``(F, N, K)`` to use a different set
+                of vectors for each frequency
+            freqs: np.array (dtype = complex) or float
+                Frequencies at which the matrix is evaluated [Hz]
+            channel_names: ``None`` (default) or `list` of `str`
+                The channels to be included in the matrix. If ``None``, all
+                channels present on the tree are included in the calculation
+            indexing: 'tree' or 'locs'
+                Whether the indexing order of `rhs` corresponds to the tree
+                nodes (order in which they occur in the iteration) or to the
+                locations on which the reduced model is based
+            use_conc: bool
+                wheter or not to use the concentration dynamics
+
+        Returns
+        -------
+            `np.ndarray`
+                The product of the impedance matrix with `rhs`. If `freqs` is
+                an array, the first dimension corresponds to the frequency
+        """
+        s_mat = self.calcSystemMatrix(freqs=freqs, channel_names=channel_names,
+                                      indexing=indexing, use_conc=use_conc)
+        rhs = np.asarray(rhs)
+        rhs_ = rhs[:,None] if rhs.ndim == 1 else rhs
+        # explicitly broadcast to prevent `np.linalg.solve` from interpreting
+        # a single right hand side matrix as a stack of vectors
+        if s_mat.ndim == 3 and rhs_.ndim == 2:
+            rhs_ = np.broadcast_to(rhs_, (s_mat.shape[0],) + rhs_.shape)
+        v_sol = np.linalg.solve(s_mat, rhs_)
+        return v_sol[...,0] if rhs.ndim == 1 else v_sol
 
     def calcConductanceMatrix(self, indexing='locs'):
         """
@@ -630,23 +717,39 @@ class CompartmentTree(STree):
         `np.ndarray` (``dtype = float``, ``ndim = 2``)
             the conductance matrix
         """
-        g_mat = np.zeros((len(self), len(self)))
-        for node in self:
-            ii = node.index
-            g_mat[ii, ii] += node.getGTot(self.channel_storage) + node.g_c
-            if node.parent_node is not None:
-                jj = node.parent_node.index
-                g_mat[jj,jj] += node.g_c
-                g_mat[ii,jj] -= node.g_c
-                g_mat[jj,ii] -= node.g_c
+        # gather the node parameters in a single pass over the tree
+        idx, pidx, g_c, g_tot, loc_inds = [np.array(arr) for arr in zip(*[
+                (node.index,
+                 -1 if node.parent_node is None else node.parent_node.index,
+                 node.g_c, node.getGTot(self.channel_storage), node.loc_ind) \
+                for node in self])]
+        g_mat = self._calcCouplingMatrix(idx, pidx, g_c, g_diag=g_tot)
         if indexing == 'locs':
-            return self._permuteToLocs(g_mat)
+            return self._permuteToLocs(g_mat, loc_inds=loc_inds)
         elif indexing == 'tree':
             return g_mat
         else:
             raise ValueError('invalid argument for `indexing`, ' + \
                              'has to be \'tree\' or \'locs\'')
 
+    def _calcCouplingMatrix(self, idx, pidx, g_c, g_diag=None):
+        """
+        Constructs the matrix of coupling conductances in tree indexing, given
+        the node indices `idx`, the parent indices `pidx` and the coupling
+        conductances `g_c` of the nodes in iteration order. Iteration starts
+        at the root, so the first node is the only one without a parent.
+        Optionally, `g_diag` is added to the diagonal
+        """
+        ii, jj, g_cc = idx[1:], pidx[1:], g_c[1:]
+        # `np.bincount` returns integers for empty input
+        g_d = np.bincount(jj, weights=g_cc, minlength=len(idx)).astype(float,
+                                                                   copy=False)
+        g_d[idx] += g_c if g_diag is None else g_c + g_diag
+        g_mat = np.diag(g_d)
+        g_mat[ii, jj] -= g_cc
+        g_mat[jj, ii] -= g_cc
+        return g_mat
+
     def calcSystemMatrix(self, freqs=0., channel_names=None,
                                with_ca=True, use_conc=False,
                                indexing='locs'):
@@ -686,32 +789,39 @@ class CompartmentTree(STree):
         if channel_names is None:
             channel_names = ['L'] + list(self.channel_storage.keys())
 
-        s_mat = np.zeros((len(freqs), len(self), len(self)), dtype=freqs.dtype)
+        # the membrane contributions only affect the diagonal, they are
+        # accumulated in place for each node
+        node_data, d_arr = [], []
         for node in self:
-            ii = node.index
-            # set the capacitance contribution
-            if with_ca: s_mat[:,ii,ii] += freqs * node.ca
-            # set the coupling conductances
-            s_mat[:,ii,ii] += node.g_c
-            if node.parent_node is not None:
-                jj = node.parent_node.index
-                s_mat[:,jj,jj] += node.g_c
-                s_mat[:,ii,jj] -= node.g_c
-                s_mat[:,jj,ii] -= node.g_c
+            node_data.append((node.index,
+                -1 if node.parent_node is None else node.parent_node.index,
+                node.g_c, node.ca, node.loc_ind))
+            d_node = np.zeros(len(freqs), dtype=freqs.dtype)
             # set the ion channel contributions
             g_terms = node.calcMembraneConductanceTerms(self.channel_storage,
                             freqs=freqs, channel_names=channel_names)
-            s_mat[:,ii,ii] += sum([node.currents[c_name][0] * g_term \
-                                   for c_name, g_term in g_terms.items()])
+            for c_name, g_term in g_terms.items():
+                d_node += node.currents[c_name][0] * g_term
             if use_conc:
                 for ion, concmech in node.concmechs.items():
                     c_term = node.calcMembraneConcentrationTerms(
                                         ion, self.channel_storage,
                                         freqs=freqs, channel_names=channel_names)
-                    s_mat[:,ii,ii] += concmech.gamma * c_term
+                    d_node += concmech.gamma * c_term
+            d_arr.append(d_node)
+        idx, pidx, g_c, ca, loc_inds = [np.array(arr) for arr in zip(*node_data)]
+        d_arr = np.array(d_arr).T
+        # set the capacitance contribution
+        if with_ca:
+            d_arr += freqs[:,None] * ca[None,:]
+        # set the coupling conductances, broadcasted to all frequencies, and
+        # add the membrane contributions to the diagonal in a single write
+        s_mat = np.empty((len(freqs), len(idx), len(idx)), dtype=freqs.dtype)
+        s_mat[:] = self._calcCouplingMatrix(idx, pidx, g_c)
+        s_mat[:,idx,idx] += d_arr
 
         if indexing == 'locs':
-            s_mat = self._permuteToLocs(s_mat)
+            s_mat = self._permuteToLocs(s_mat, loc_inds=loc_inds)
         elif not indexing == 'tree':
             raise ValueError('invalid argument for `indexing`, ' + \
                              'has to be \'tree\' or \'locs\'')
@@ -847,107 +957,135 @@ class CompartmentTree(STree):
         z_mat_arg = z_mat_arg_
         return freqs, w_freqs, z_mat_arg
 
-    def _toStructureTensorGMC(self, channel_names):
-        g_vec = self._toVecGMC(channel_names)
-        g_struct = np.zeros((len(self), len(self), len(g_vec)))
-        kk = 0 # counter
+    def _toFeatureMatGMC(self, z_mat, channel_names):
+        """
+        Construct the feature matrix for the membrane and coupling conductance
+        fit by writing the affected columns of `z_mat` directly, instead of
+        contracting `z_mat` with a (mostly zero) structure tensor
+        """
+        n_c, n_chan = len(self), len(channel_names)
+        idx, pidx, g_terms = [], [], []
         for node in self:
-            ii = node.index
-            g_terms = node.calcMembraneConductanceTerms(self.channel_storage,
+            idx.append(node.index)
+            pidx.append(-1 if node.parent_node is None else node.parent_node.index)
+            g_terms_node = node.calcMembraneConductanceTerms(self.channel_storage,
                                 freqs=0., channel_names=['L']+channel_names)
-            if node.parent_node == None:
-                # membrance conductance elements
-                for channel_name in channel_names:
-                    g_struct[0, 0, kk] += g_terms[channel_name]
-                    kk += 1
-            else:
-                jj = node.parent_node.index
-                # coupling conductance element
-                g_struct[ii, jj, kk] -= 1.
-                g_struct[jj, ii, kk] -= 1.
-                g_struct[jj, jj, kk] += 1.
-                g_struct[ii, ii, kk] += 1.
-                kk += 1
-                # membrance conductance elements
-                for channel_name in channel_names:
-                    g_struct[ii, ii, kk] += g_terms[channel_name]
-                    kk += 1
-        return g_struct
+            g_terms.append([g_terms_node[c_name] for c_name in channel_names])
+        idx, pidx = np.array(idx), np.array(pidx)
+        # index of the first parameter of each node in the parameter vector,
+        # the root comes first and has no coupling conductance
+        n_param = np.full(n_c, n_chan+1)
+        n_param[0] = n_chan
+        k_start = np.cumsum(n_param) - n_param
+        tensor_feature = np.zeros((n_c, n_c, np.sum(n_param)),
+                                  dtype=np.result_type(z_mat, float))
+        # coupling conductance elements
+        ii, jj, kk = idx[1:], pidx[1:], k_start[1:]
+        z_diff = z_mat[:,ii] - z_mat[:,jj]
+        tensor_feature[:,ii,kk] += z_diff
+        tensor_feature[:,jj,kk] -= z_diff
+        # membrance conductance elements
+        kk = (k_start + n_param - n_chan)[:,None] + np.arange(n_chan)[None,:]
+        tensor_feature[:,idx[:,None],kk] = z_mat[:,idx,None] * \
+                                           np.array(g_terms)[None,:,:]
+        return np.reshape(tensor_feature, (n_c*n_c, tensor_feature.shape[2]))
+
+    def _maskGMC(self, has_parent, n_chan):
+        """
+        Boolean mask that selects the fit parameters from an array of shape
+        ``(N, n_chan+1)``, whose first column holds the coupling conductances
+        and whose other columns hold the channel conductances. Only nodes for
+        which `has_parent` is ``True`` have a coupling conductance
+        """
+        mask = np.ones((len(has_parent), n_chan+1), dtype=bool)
+        mask[:,0] = has_parent
+        return mask
 
     def _toVecGMC(self, channel_names):
         """
         Place all conductances to be fitted in a single vector
         """
-        g_list = []
+        has_parent, g_arr = [], []
         for node in self:
-            if node.parent_node is None:
-                g_list.extend([node.currents[c_name][0] for c_name in channel_names])
-            else:
-                g_list.extend([node.g_c] + \
-                              [node.currents[c_name][0] for c_name in channel_names])
-        return np.array(g_list)
+            has_parent.append(node.parent_node is not None)
+            g_arr.append([node.g_c] + \
+                         [node.currents[c_name][0] for c_name in channel_names])
+        return np.array(g_arr)[self._maskGMC(has_parent, len(channel_names))]
 
     def _toTreeGMC(self, g_vec, channel_names):
-        kk = 0 # counter
-        for ii, node in enumerate(self):
-            if node.parent_node is None:
-                for channel_name in channel_names:
-                    node.currents[channel_name][0] = g_vec[kk]
-                    kk += 1
-            else:
-                node.g_c = g_vec[kk]
-                kk += 1
-                for channel_name in channel_names:
-                    node.currents[channel_name][0] = g_vec[kk]
-                    kk += 1
+        nodes = list(self)
+        has_parent = [node.parent_node is not None for node in nodes]
+        g_arr = np.zeros((len(nodes), len(channel_names)+1))
+        g_arr[self._maskGMC(has_parent, len(channel_names))] = g_vec
+        for node, g_node in zip(nodes, g_arr):
+            if node.parent_node is not None:
+                node.g_c = g_node[0]
+            for channel_name, g in zip(channel_names, g_node[1:]):
+                node.currents[channel_name][0] = g
 
-    def _toStructureTensorGM(self, freqs, channel_names, all_channel_names=None):
+    def _toFeatureMatGM(self, z_mat, freqs, channel_names, all_channel_names=None):
+        """
+        Construct the feature matrix for the membrane conductance fit. Each
+        conductance only affects one column of the product of `z_mat` with the
+        conductance matrix, so all columns are written in a single vectorized
+        assignment and no structure tensor is materialized
+        """
         # to construct appropriate channel vector
         if all_channel_names is None:
             all_channel_names = channel_names
         else:
             assert set(channel_names).issubset(all_channel_names)
-        g_vec = self._toVecGM(all_channel_names)
-        g_struct = np.zeros((len(freqs), len(self), len(self), len(g_vec)), dtype=freqs.dtype)
-        # fill the fit structure
-        kk = 0 # counter
-        for node in self:
-            ii = node.index
+        n_f, n_c, n_chan = len(freqs), len(self), len(all_channel_names)
+        # membrane conductance terms, zero for channels that are not fitted
+        idx = np.zeros(n_c, dtype=int)
+        g_arr = np.zeros((n_f, n_c, n_chan), dtype=np.result_type(freqs, float))
+        for nn, node in enumerate(self):
+            idx[nn] = node.index
             g_terms = node.calcMembraneConductanceTerms(self.channel_storage,
                                     freqs=freqs, channel_names=channel_names)
-            # membrance conductance elements
-            for channel_name in all_channel_names:
+            for cc, channel_name in enumerate(all_channel_names):
                 if channel_name in channel_names:
-                    g_struct[:,ii,ii,kk] += g_terms[channel_name]
-                kk += 1
-        return g_struct
+                    g_arr[:,nn,cc] = g_terms[channel_name]
+        # fill the feature tensor
+        tensor_feature = np.zeros((n_f, n_c, n_c, n_c*n_chan),
+                                  dtype=np.result_type(z_mat, g_arr))
+        kk = np.reshape(np.arange(n_c*n_chan), (n_c, n_chan))
+        tensor_feature[:,:,idx[:,None],kk] = z_mat[:,:,idx,None] * \
+                                             g_arr[:,None,:,:]
+        return np.reshape(tensor_feature, (n_f*n_c*n_c, n_c*n_chan))
 
     def _toVecGM(self, channel_names):
         """
         Place all conductances to be fitted in a single vector
         """
-        g_list = []
-        for node in self:
-            g_list.extend([node.currents[c_name][0] for c_name in channel_names])
-        return np.array(g_list)
+        g_arr = np.array([[node.currents[c_name][0] for c_name in channel_names] \
+                          for node in self])
+        return np.reshape(g_arr, (-1,))
 
     def _toTreeGM(self, g_vec, channel_names):
-        kk = 0 # counter
-        for ii, node in enumerate(self):
-            for channel_name in channel_names:
-                node.currents[channel_name][0] = g_vec[kk]
-                kk += 1
-
-    def _toStructureTensorConc(self, ion, freqs, channel_names):
-        # to construct appropriate channel vector
-        c_struct = np.zeros((len(freqs), len(self), len(self), len(self)), dtype=freqs.dtype)
-        # fill the fit structure
-        for node in self:
-            ii = node.index
-            c_term = node.calcMembraneConcentrationTerms(ion, self.channel_storage,
-                                    freqs=freqs, channel_names=channel_names)
-            c_struct[:,ii,ii,ii] += c_term
-        return c_struct
+        nodes = list(self)
+        g_arr = np.reshape(g_vec, (len(nodes), len(channel_names)))
+        for node, g_node in zip(nodes, g_arr):
+            for channel_name, g in zip(channel_names, g_node):
+                node.currents[channel_name][0] = g
+
+    def _toFeatureMatConc(self, z_mat, ion, freqs, channel_names):
+        """
+        Construct the feature matrix for the concentration mechanism fit. The
+        structure tensor is diagonal in its last three indices, so the
+        contraction with `z_mat` reduces to scaling the columns of `z_mat`
+        with the concentration terms
+        """
+        n_f, n_c = len(freqs), len(self)
+        inds = np.array([node.index for node in self])
+        c_terms = np.array([node.calcMembraneConcentrationTerms(ion,
+                                self.channel_storage,
+                                freqs=freqs, channel_names=channel_names) \
+                            for node in self]).T
+        tensor_feature = np.zeros((n_f, n_c, n_c, n_c),
+                                  dtype=np.result_type(z_mat, c_terms))
+        tensor_feature[:,:,inds,inds] = z_mat[:,:,inds] * c_terms[:,None,:]
+        return np.reshape(tensor_feature, (n_f*n_c*n_c, n_c))
 
     def _toVecConc(self, ion):
         """
@@ -956,24 +1094,38 @@ class CompartmentTree(STree):
         return np.array([node.concmechs[ion].gamma for node in self])
 
     def _toTreeConc(self, c_vec, ion):
-        for ii, node in enumerate(self):
-            node.concmechs[ion].gamma = c_vec[ii]
-
-    def _toStructureTensorC(self, freqs):
-        c_vec = self._toVecC()
-        c_struct = np.zeros((len(freqs), len(self), len(self), len(c_vec)), dtype=complex)
-        for node in self:
-            ii = node.index
-            # capacitance elements
-            c_struct[:, ii, ii, ii] += freqs
-        return c_struct
+        for node, c in zip(self, c_vec):
+            node.concmechs[ion].gamma = c
 
     def _toVecC(self):
         return np.array([node.ca for node in self])
 
     def _toTreeC(self, c_vec):
-        for ii, node in enumerate(self):
-            node.ca = c_vec[ii]
+        for node, c in zip(self, c_vec):
+            node.ca = c
+
+    def _getVecEye(self):
+        """
+        Returns the flattened identity matrix of size `len(self)`, which is
+        the target vector for the impedance matrix fits
+        """
+        n_node = len(self)
+        if self._vec_eye is None or self._vec_eye.size != n_node*n_node:
+            self._vec_eye = np.reshape(np.eye(n_node), (n_node*n_node,))
+        return self._vec_eye
+
+    def _calcTargetVec(self, z_mat, g_mat):
+        """
+        Returns the flattened target of the impedance matrix fits, the identity
+        minus the product of `z_mat` with `g_mat` for each frequency. The
+        product is negated in place, so no second ``(F, N, N)`` array is
+        allocated
+        """
+        mat_target = np.matmul(z_mat, g_mat)
+        np.negative(mat_target, out=mat_target)
+        idx = np.arange(mat_target.shape[-1])
+        mat_target[:,idx,idx] += 1.
+        return np.reshape(mat_target, (-1,))
 
     def computeGMC(self, z_mat_arg, e_eqs=None, channel_names=['L']):
         """
@@ -1005,20 +1157,13 @@ class CompartmentTree(STree):
             # set equilibrium conductances
             self.setEEq(e_eq)
             # create the matrices for linear fit
-            g_struct = self._toStructureTensorGMC(channel_names)
-            tensor_feature = np.einsum('ij,jkl->ikl', z_mat, g_struct)
-            tshape = tensor_feature.shape
-            mat_feature_aux = np.reshape(tensor_feature,
-                                         (tshape[0]*tshape[1], tshape[2]))
-            vec_target_aux = np.reshape(np.eye(len(self)), (len(self)*len(self),))
+            mat_feature_aux = self._toFeatureMatGMC(z_mat, channel_names)
             mats_feature.append(mat_feature_aux)
-            vecs_target.append(vec_target_aux)
+            vecs_target.append(self._getVecEye())
         mat_feature = np.concatenate(mats_feature, 0)
         vec_target = np.concatenate(vecs_target)
         # linear regression fit
-        # res = la.lstsq(mat_feature, vec_target)
-        res = so.nnls(mat_feature, vec_target)
-        g_vec = res[0].real
+        g_vec = self._fitNNLS(mat_feature, vec_target)
         # set the conductances
         self._toTreeGMC(g_vec, channel_names)
 
@@ -1081,18 +1226,12 @@ class CompartmentTree(STree):
         # set channel expansion point
         self.setExpansionPoints(sv)
         # feature matrix
-        g_struct = self._toStructureTensorGM(freqs=freqs, channel_names=channel_names,
-                                             all_channel_names=all_channel_names)
-        tensor_feature = np.einsum('oij,ojkl->oikl', z_mat, g_struct)
-        tshape = tensor_feature.shape
-        mat_feature = np.reshape(tensor_feature,
-                                     (tshape[0]*tshape[1]*tshape[2], tshape[3]))
+        mat_feature = self._toFeatureMatGM(z_mat, freqs, channel_names,
+                                           all_channel_names=all_channel_names)
         # target vector
         g_mat = self.calcSystemMatrix(freqs,
                             channel_names=other_channel_names, indexing='tree')
-        zg_prod = np.einsum('oij,ojk->oik', z_mat, g_mat)
-        mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
-        vec_target = np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],))
+        vec_target = self._calcTargetVec(z_mat, g_mat)
 
         return self._fitResAction(action, mat_feature, vec_target, weight,
                                   channel_names=all_channel_names)
@@ -1158,18 +1297,12 @@ class CompartmentTree(STree):
         # set channel expansion point
         self.setExpansionPoints(sv)
         # feature matrix
-        g_struct = self._toStructureTensorGM(freqs=freqs, channel_names=[channel_name],
-                                             all_channel_names=all_channel_names)
-        tensor_feature = np.einsum('oij,ojkl->oikl', z_mat, g_struct)
-        tshape = tensor_feature.shape
-        mat_feature = np.reshape(tensor_feature,
-                                     (tshape[0]*tshape[1]*tshape[2], tshape[3]))
+        mat_feature = self._toFeatureMatGM(z_mat, freqs, [channel_name],
+                                           all_channel_names=all_channel_names)
         # target vector
         g_mat = self.calcSystemMatrix(freqs,
                             channel_names=other_channel_names, indexing='tree')
-        zg_prod = np.einsum('oij,ojk->oik', z_mat, g_mat)
-        mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
-        vec_target = np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],))
+        vec_target = self._calcTargetVec(z_mat, g_mat)
 
         self.removeExpansionPoints()
 
@@ -1193,19 +1326,12 @@ class CompartmentTree(STree):
         # set equilibrium conductances
         self.setEEq(e_eq)
         # feature matrix
-        g_struct = self._toStructureTensorConc(ion, freqs, channel_names)
-
-        tensor_feature = np.einsum('oij,ojkl->oikl', z_mat, g_struct)
-        tshape = tensor_feature.shape
-        mat_feature = np.reshape(tensor_feature,
-                                     (tshape[0]*tshape[1]*tshape[2], tshape[3]))
+        mat_feature = self._toFeatureMatConc(z_mat, ion, freqs, channel_names)
         # target vector
         g_mat = self.calcSystemMatrix(freqs, channel_names=channel_names+['L'],
                                              indexing='tree')
 
-        zg_prod = np.einsum('oij,ojk->oik', z_mat, g_mat)
-        mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
-        vec_target = np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],))
+        vec_target = self._calcTargetVec(z_mat, g_mat)
 
         # print(np.set_printoptions(precision=2))
         # print('z_mat fitted   =\n', self.calcImpedanceMatrix(use_conc=True, freqs=freqs, channel_names=channel_names)[0].real)
@@ -1244,15 +1370,17 @@ class CompartmentTree(STree):
         c_lim =  g_tot / (-alphas[0] * tau_eps)
         gamma_mat = alphas[:,None] * phimat * c_lim[None,:]
 
-        # construct feature matrix and target vector
-        mat_feature = np.zeros((n_a*n_c, n_c))
-        vec_target = np.zeros(n_a*n_c)
-        for ii, node in enumerate(self):
-            mat_feature[ii*n_a:(ii+1)*n_a,ii] = alphas * phimat[:,ii] * weights
-            vec_target[ii*n_a:(ii+1)*n_a] = np.reshape(np.dot(phimat, g_mat[ii:ii+1,:].T) - gamma_mat[:,ii:ii+1], n_a) * weights
+        # construct feature matrix and target vector, the feature matrix is
+        # block diagonal with one block of eigenmodes per compartment
+        inds = np.arange(n_c)
+        mat_feature = np.zeros((n_c, n_a, n_c))
+        mat_feature[inds,:,inds] = (alphas * weights)[None,:] * phimat.T
+        mat_feature = np.reshape(mat_feature, (n_c*n_a, n_c))
+        vec_target = (np.dot(phimat, g_mat.T) - gamma_mat) * weights[:,None]
+        vec_target = np.reshape(vec_target.T, n_c*n_a)
 
         # least squares fit
-        res = so.nnls(mat_feature, vec_target)[0]
+        res = self._fitNNLS(mat_feature, vec_target)
         c_vec = res + c_lim
         self._toTreeC(c_vec)
 
@@ -1501,12 +1629,31 @@ class CompartmentTree(STree):
         return self._fitResAction(action, mat_feature, vec_target, weight,
                                   channel_names=all_channel_names)
 
+    def _fitNNLS(self, mat_feature, vec_target):
+        """
+        Non-negative least squares fit of real-valued parameters. Complex
+        systems are split into separate equations for the real and imaginary
+        parts, as `scipy.optimize.nnls` would discard the imaginary parts.
+        The columns of the feature matrix are scaled to unit norm to improve
+        the conditioning of the fit, the positive scale factors do not alter
+        the non-negativity constraints
+        """
+        if np.iscomplexobj(mat_feature) or np.iscomplexobj(vec_target):
+            if np.any(mat_feature.imag) or np.any(vec_target.imag):
+                mat_feature = np.concatenate((mat_feature.real, mat_feature.imag))
+                vec_target = np.concatenate((vec_target.real, vec_target.imag))
+            else:
+                mat_feature, vec_target = mat_feature.real, vec_target.real
+        col_norms = np.linalg.norm(mat_feature, axis=0)
+        col_norms[col_norms == 0.] = 1.
+        vec_res = so.nnls(mat_feature / col_norms[None,:], vec_target)[0]
+        return vec_res / col_norms
+
     def _fitResAction(self, action, mat_feature, vec_target, weight,
                             ca_lim=[], **kwargs):
         if action == 'fit':
             # linear regression fit
-            res = so.nnls(mat_feature, vec_target)
-            vec_res = res[0].real
+            vec_res = self._fitNNLS(mat_feature, vec_target)
             # set the conductances
             if 'channel_names' in kwargs:
                 self._toTreeGM(vec_res, channel_names=kwargs['channel_names'])
@@ -1547,7 +1694,7 @@ class CompartmentTree(STree):
                     except AssertionError:
                         raise IOError('`ion` does not agree with stored ion for ' + \
                                       'other fits:\n' + \
-                                      '`ion`: ' + kwargs[ion] + \
+                                      '`ion`: ' + kwargs['ion'] + \
                                       '\nstored ion: ' + self.fit_data['ion'])
 
             self.fit_data['mats_feature'].append(mat_feature)
@@ -1574,14 +1721,19 @@ class CompartmentTree(STree):
         """
         fit_data = self.fit_data
         if len(fit_data['mats_feature']) > 0:
-            # apply the weights
+            # create the fit matrices, the weighted blocks are written
+            # directly into the stacked arrays
+            n_row = sum([len(v_t) for v_t in fit_data['vecs_target']])
+            mat_feature = np.empty((n_row, fit_data['mats_feature'][0].shape[1]),
+                                   dtype=np.result_type(*fit_data['mats_feature']))
+            vec_target = np.empty(n_row,
+                                  dtype=np.result_type(*fit_data['vecs_target']))
+            i0 = 0
             for (m_f, v_t, w_f) in zip(fit_data['mats_feature'], fit_data['vecs_target'], fit_data['weights_fit']):
                 nn = len(v_t)
-                m_f *= w_f / nn
-                v_t *= w_f / nn
-            # create the fit matrices
-            mat_feature = np.concatenate(fit_data['mats_feature'])
-            vec_target = np.concatenate(fit_data['vecs_target'])
+                np.multiply(m_f, w_f / nn, out=mat_feature[i0:i0+nn])
+                np.multiply(v_t, w_f / nn, out=vec_target[i0:i0+nn])
+                i0 += nn
             # do the fit
             if len(fit_data['channel_names']) > 0:
                 self._fitResAction('fit', mat_feature, vec_target, 1.,
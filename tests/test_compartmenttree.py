@@ -4,6 +4,7 @@ import matplotlib.pyplot as pl
 import pytest
 import random
 import copy
+import pickle
 
 from neat import SOVTree, SOVNode, Kernel, GreensTree, CompartmentTree, CompartmentNode
 import neat.tools.kernelextraction as ke
@@ -283,6 +284,24 @@ class TestCompartmentTree():
         assert np.allclose(gm1, gm5)
         assert not np.allclose(gm1, gm6)
 
+        # impedance matrix products
+        freqs = np.array([0., 10j, 100j])
+        i_in = np.random.rand(n_loc+1, 2)
+        z_mat = self.ctree.calcImpedanceMatrix(freqs=freqs)
+        v_out = self.ctree.solveSystem(i_in, freqs=freqs)
+        assert np.allclose(v_out, np.matmul(z_mat, i_in))
+        v_out = self.ctree.solveSystem(i_in[:,0], freqs=freqs)
+        assert np.allclose(v_out, np.matmul(z_mat, i_in[:,0]))
+        i_in_f = np.random.rand(len(freqs), n_loc+1, 3)
+        v_out = self.ctree.solveSystem(i_in_f, freqs=freqs)
+        assert np.allclose(v_out, np.matmul(z_mat, i_in_f))
+        v_out = self.ctree.solveSystem(i_in)
+        assert np.allclose(v_out, np.dot(self.ctree.calcImpedanceMatrix(), i_in))
+        # the stored impedance matrix is not modified through the returned one
+        z_mat_ = self.ctree.calcImpedanceMatrix(freqs=freqs, indexing='tree')
+        z_mat_[:] = 0.
+        assert np.allclose(self.ctree.calcImpedanceMatrix(freqs=freqs), z_mat)
+
         # eigenvalues
         alphas, phimat, phimat_inv = self.ctree.calcEigenvalues()
         ca_vec = np.array([1./node.ca for node in self.ctree]) * 1e-3
@@ -515,6 +534,96 @@ class TestCompartmentTree():
         ctree.fitEL()
         assert np.abs(ctree[0].currents['L'][1] - self.greens_tree[1].currents['L'][1]) < 1e-10
 
+    def testComplexChannelFit(self):
+        """
+        1   2
+         \ /
+          0
+        """
+        croot = CompartmentNode(0, loc_ind=0, g_l=0.01)
+        cnode1 = CompartmentNode(1, loc_ind=1, g_c=0.05, g_l=0.005)
+        cnode2 = CompartmentNode(2, loc_ind=2, g_c=0.02, g_l=0.002)
+        ctree = CompartmentTree(root=croot)
+        ctree.addNodeWithParent(cnode1, croot)
+        ctree.addNodeWithParent(cnode2, croot)
+        ctree.addCurrent(channelcollection.Na_Ta(), 50.)
+        ctree.addCurrent(channelcollection.Kv3_1(), -85.)
+        for node, g_na, g_k in zip(ctree, [0.02, 0.01, 0.], [0.03, 0.01, 0.005]):
+            node.currents['Na_Ta'][0] = g_na
+            node.currents['Kv3_1'][0] = g_k
+        ctree.setEEq(-60.)
+        # impedance matrices at complex frequencies
+        freqs = np.array([0., 10j, 100j, 1.+50j])
+        z_mat = ctree.calcImpedanceMatrix(freqs=freqs)
+        e_eq = ctree.getEEq()
+        # refit the channel conductances
+        ctree_fit = copy.deepcopy(ctree)
+        for node in ctree_fit:
+            node.currents['Na_Ta'][0] = 0.
+            node.currents['Kv3_1'][0] = 0.
+        ctree_fit.computeGChanFromImpedance(['Kv3_1', 'Na_Ta'], z_mat, e_eq, freqs,
+                                            other_channel_names=['L'], action='fit')
+        assert np.allclose(ctree_fit._toVecGM(['Kv3_1', 'Na_Ta']),
+                           ctree._toVecGM(['Kv3_1', 'Na_Ta']))
+
+    def testCacheValidation(self):
+        """
+        1   2
+         \ /
+          0
+        """
+        croot = CompartmentNode(0, loc_ind=1, g_l=0.01)
+        cnode1 = CompartmentNode(1, loc_ind=0, g_c=0.05, g_l=0.005)
+        cnode2 = CompartmentNode(2, loc_ind=2, g_c=0.02, g_l=0.002)
+        ctree = CompartmentTree(root=croot)
+        ctree.addNodeWithParent(cnode1, croot)
+        ctree.addNodeWithParent(cnode2, croot)
+        freqs = np.array([0., 10j])
+
+        def checkSolve():
+            i_in = np.random.rand(len(ctree), 2)
+            s_mat = ctree.calcSystemMatrix(freqs=freqs)
+            v_out = ctree.solveSystem(i_in, freqs=freqs)
+            assert np.allclose(v_out, np.linalg.solve(s_mat, np.array([i_in, i_in])))
+            for indexing in ['locs', 'tree']:
+                s_mat = ctree.calcSystemMatrix(freqs=freqs, indexing=indexing)
+                z_mat = ctree.calcImpedanceMatrix(freqs=freqs, indexing=indexing)
+                assert np.allclose(z_mat, np.linalg.inv(s_mat))
+
+        checkSolve()
+        # direct changes of node parameters
+        cnode1.g_c = 0.1
+        checkSolve()
+        cnode2.currents['L'][0] = 0.004
+        checkSolve()
+        cnode2.ca = 2.
+        checkSolve()
+        cnode1.loc_ind, cnode2.loc_ind = 2, 0
+        checkSolve()
+        # changes of the tree structure
+        cnode3 = CompartmentNode(3, loc_ind=3, g_c=0.01, g_l=0.001)
+        ctree.addNodeWithParent(cnode3, cnode2)
+        checkSolve()
+
+        # the stored impedance matrix is not copied along with the tree
+        for ctree_ in [copy.deepcopy(ctree), copy.copy(ctree),
+                       pickle.loads(pickle.dumps(ctree))]:
+            assert ctree_._z_mat_cache.z_mat is None
+            assert np.allclose(ctree_.calcImpedanceMatrix(freqs=freqs),
+                               ctree.calcImpedanceMatrix(freqs=freqs))
+
+    def testFitStorage(self):
+        ctree = CompartmentTree(root=CompartmentNode(0, loc_ind=0))
+        mat_feature, vec_target = np.ones((1,1)), np.ones(1)
+        ctree._fitResAction('store', mat_feature, vec_target, 1., ion='ca')
+        # stored matrices of different fit types can not be mixed
+        with pytest.raises(IOError):
+            ctree._fitResAction('store', mat_feature, vec_target, 1., ion='na')
+        with pytest.raises(IOError):
+            ctree._fitResAction('store', mat_feature, vec_target, 1.,
+                                channel_names=['L'])
+        assert len(ctree.fit_data['mats_feature']) == 1
+
 
 class TestCompartmentTreePlotting():
     def _initTree1(self):